@@ -3,15 +3,21 @@
 
 __author__ = 'dracarysX'
 
+import datetime
 from collections import deque
-from peewee import Expression, ForeignKeyField
+from functools import reduce
+from peewee import Expression, ForeignKeyField, DateField, DateTimeField, TimeField, SqliteDatabase, fn
 
 from rest_query.operator import Operator, operator_list
 from rest_query.query import QueryBuilder
-from rest_query.parser import BaseParamsParser, cache_property
+from rest_query.parser import BaseParamsParser, ParserException, cache_property
 from rest_query.models import ModelExtra
 from rest_query.serializer import BaseSerializer
 
+# alias of the row watermark and primary key columns selected in delta mode
+WATERMARK = '_watermark'
+WATERMARK_ID = '_watermark_id'
+
 
 class PeeweeModelExtraMixin(ModelExtra):
     """
@@ -62,13 +68,18 @@ class PeeweeOperator(Operator):
 
 
 class PeeweeParamsParser(PeeweeModelExtraMixin, BaseParamsParser):
-    
+
     operator_engine = PeeweeOperator
+    since_flag = 'since'
+    since_id_flag = 'since_id'
 
     def __init__(self, params_args, model=None, **kwargs):
         super(PeeweeParamsParser, self).__init__(params_args, **kwargs)
         self.model = model
         self.foreign_key = ForeignKeyField
+        # per parser cache, ModelExtra class level dict is shared by all models
+        self.field_map = {}
+        self.join_model = {}
 
     def parse_select(self):
         selects = super(PeeweeParamsParser, self).parse_select()
@@ -105,17 +116,166 @@ class PeeweeParamsParser(PeeweeModelExtraMixin, BaseParamsParser):
         paginate = super(PeeweeParamsParser, self).parse_paginate()
         return (paginate['page'], paginate['limit'])
 
+    def parse_since(self):
+        """
+        >>> parse_since()
+        '2017-06-01 12:00:00'
+        """
+        return self.params_args.get(self.since_flag, None)
+
+    def parse_since_id(self):
+        since_id = self.params_args.get(self.since_id_flag, None)
+        return None if since_id == '' else since_id
+
+    def parse_select_models(self):
+        """
+        models appear in the select tree, must call after parse_select.
+        >>> parse_select_models()
+        [<class 'Book'>, <class 'Author'>, <class 'School'>]
+        """
+        models = [self.model]
+        for select in self.select_list:
+            model = self.model
+            for field_name in select.split('.')[:-1]:
+                model = self.foreign_model(self.field_by_model(model, field_name))
+                if model not in models:
+                    models.append(model)
+        return models
+
 
 class PeeweeQueryBuilder(QueryBuilder):
     """
     query builder for peewee orm
+    delta mode: with modified_field configured, `since=<watermark>` only returns
+    rows changed after the watermark (in the model or joined select models),
+    ordered by watermark.
+    >>> builder = PeeweeQueryBuilder(Book, {'since': '2017-06-01 12:00:00'}, modified_field='updated_at')
+    >>> builder.build()
     """
     parser_engine = PeeweeParamsParser
-
-    def __init__(self, model, params, **kwargs):
+    # modification column name, shared by the model, joined models and tombstone model
+    modified_field = None
+    # model recording deleted ids, with tombstone_field and modified_field columns
+    tombstone_model = None
+    tombstone_field = 'object_id'
+    # sql function return the largest argument, default by database:
+    # `MAX` for sqlite, `GREATEST` for mysql and postgresql
+    greatest_function = None
+
+    def __init__(self, model, params, modified_field=None, tombstone_model=None, **kwargs):
         super(PeeweeQueryBuilder, self).__init__(model, params, **kwargs)
+        if modified_field is not None:
+            self.modified_field = modified_field
+        if tombstone_model is not None:
+            self.tombstone_model = tombstone_model
+        self.since = self.since_id = None
+        if self.modified_field is not None:
+            # since and since_id are delta params, not model field filters
+            self.parser.exclude_where = self.parser.exclude_where + [
+                self.parser.since_flag, self.parser.since_id_flag
+            ]
+            self.where = self.parser.parse_where()
+            since = self.parser.parse_since()
+            if since is not None:
+                self.since = self.parse_watermark(since)
+                since_id = self.parser.parse_since_id()
+                if since_id is not None:
+                    try:
+                        self.since_id = self.model._meta.primary_key.python_value(since_id)
+                    except (TypeError, ValueError):
+                        raise ParserException('Param since_id is not a valid primary key value.')
+                if self.paginate[1] < 1:
+                    raise ParserException('Param limit must be greater than 0 in delta mode.')
+
+    @property
+    def is_delta(self):
+        return self.since is not None
+
+    def parse_watermark(self, value):
+        field = self.model._meta.fields[self.modified_field]
+        try:
+            watermark = field.python_value(value)
+        except (TypeError, ValueError):
+            watermark = None
+        # DateTimeField return unparseable string as it is
+        if watermark is None or (isinstance(field, (DateField, DateTimeField, TimeField)) and
+                                 not isinstance(watermark, (datetime.date, datetime.time))):
+            raise ParserException('Param since is not a valid {} value.'.format(self.modified_field))
+        return watermark
+
+    def watermark_fields(self):
+        return [
+            model._meta.fields[self.modified_field] for model in self.parser.parse_select_models()
+            if self.modified_field in model._meta.fields
+        ]
+
+    def watermark(self):
+        """
+        row watermark, the largest not NULL modified_field of model and joined select models.
+        """
+        fields = self.watermark_fields()
+        if len(fields) == 1:
+            return fields[0]
+        # fill NULL with other fields, NULL only if all fields are NULL
+        args = [fn.COALESCE(field, *(fields[:i] + fields[i + 1:])) for i, field in enumerate(fields)]
+        function = self.greatest_function
+        if function is None:
+            function = 'MAX' if isinstance(self.model._meta.database, SqliteDatabase) else 'GREATEST'
+        return getattr(fn, function)(*args)
+
+    def upper_watermark(self):
+        """
+        largest watermark at present, read before rows and tombstones so both stop at the same bound.
+        """
+        if not hasattr(self, '_upper_watermark'):
+            fields = self.watermark_fields()
+            if self.tombstone_model is not None:
+                fields.append(self.tombstone_model._meta.fields[self.modified_field])
+            python_value = self.model._meta.fields[self.modified_field].python_value
+            watermarks = [field.model_class.select(fn.MAX(field)).scalar() for field in fields]
+            watermarks = [python_value(w) for w in watermarks if w is not None]
+            self._upper_watermark = max(watermarks + [self.since])
+        return self._upper_watermark
+
+    def build_delta(self):
+        fields = self.watermark_fields()
+        watermark = self.watermark()
+        primary_key = self.model._meta.primary_key
+        condition = reduce(lambda x, y: x | y, [field > self.since for field in fields])
+        if self.since_id is not None:
+            # rows share the since watermark after since_id are not returned yet
+            condition = condition | ((watermark == self.since) & (primary_key > self.since_id))
+        query = self.model.select(
+            *(self.select or [self.model]) + [watermark.alias(WATERMARK), primary_key.alias(WATERMARK_ID)]
+        )
+        query = query.where(condition, watermark <= self.upper_watermark())
+        if self.where:
+            query = query.where(*self.where)
+        query = query.order_by(watermark, primary_key)
+        for model, condition in self.parser.join_model.items():
+            query = query.join(model, on=condition)
+        # page by (watermark, id) cursor instead of offset
+        return query.limit(self.paginate[1])
+
+    def build_tombstones(self, until=None):
+        """
+        deleted ids after since watermark, until upper watermark.
+        >>> list(builder.build_tombstones())
+        [(id, watermark), ...]
+        """
+        if not self.is_delta or self.tombstone_model is None:
+            return None
+        if until is None:
+            until = self.upper_watermark()
+        fields = self.tombstone_model._meta.fields
+        modified = fields[self.modified_field]
+        return self.tombstone_model.select(
+            fields[self.tombstone_field], modified
+        ).where(modified > self.since, modified <= until).order_by(modified).tuples()
 
     def build(self):
+        if self.is_delta:
+            return self.build_delta()
         query = self.model.select(*self.select)
         if self.where:
             query = query.where(*self.where)
@@ -206,6 +366,38 @@ class PeeweeSerializer(BaseSerializer):
             _serializer(data, i, obj)
         return data
 
+    def delta_data(self, builder):
+        """
+        serializer for delta query, object_list must be built by builder in delta mode.
+        next request with `since=<watermark>&since_id=<watermark_id>`, watermark_id is None
+        when all rows at watermark returned.
+        >>> builder = PeeweeQueryBuilder(Book, {'since': 'xxx'}, modified_field='updated_at')
+        >>> serializer = PeeweeSerializer(object_list=builder.build(), select_args=builder.parser.select_list)
+        >>> serializer.delta_data(builder)
+        {
+            'object_list': [...],
+            'watermark': xxx,
+            'watermark_id': xxx,
+            'deleted': [xxx, xxx]
+        }
+        """
+        if not builder.is_delta:
+            raise ValueError('Builder is not in delta mode, modified_field and since are required.')
+        object_list = list(self.object_list)
+        if len(object_list) >= builder.paginate[1]:
+            # more rows pending, cursor stop at the last row returned
+            python_value = builder.model._meta.fields[builder.modified_field].python_value
+            watermark = python_value(getattr(object_list[-1], WATERMARK))
+            watermark_id = getattr(object_list[-1], WATERMARK_ID)
+        else:
+            watermark, watermark_id = builder.upper_watermark(), None
+        return {
+            'object_list': [self.serializer(obj=obj) for obj in object_list],
+            'watermark': watermark,
+            'watermark_id': watermark_id,
+            'deleted': [t[0] for t in builder.build_tombstones(watermark) or []]
+        }
+
     # def serializer(self, obj):
     #     """
     #     single obj serializer.
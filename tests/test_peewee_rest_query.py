@@ -2,9 +2,11 @@
 # -*-coding: utf-8 -*-
 __author__ = 'dracarysX'
 
+import datetime
 import unittest
 from peewee import *
 from peewee_rest_query import *
+from rest_query.parser import ParserException
 
 
 # define peewee model
@@ -17,12 +19,24 @@ class Author(Model):
     id = IntegerField()
     name = CharField()
     school = ForeignKeyField(School)
+    updated_at = DateTimeField()
 
 
 class Book(Model):
     id = IntegerField()
     name = CharField()
     author = ForeignKeyField(Author)
+    updated_at = DateTimeField()
+
+
+class Event(Model):
+    id = IntegerField()
+    since = CharField()
+
+
+class BookDeleted(Model):
+    object_id = IntegerField()
+    updated_at = DateTimeField()
 
 
 class PeeweeOperatorTest(unittest.TestCase):
@@ -162,3 +176,189 @@ class PeeweeQueryBuilderTest(unittest.TestCase):
         self.assertTrue(query.sql()[0].endswith(
             '''WHERE (("t1"."name" LIKE ?) AND ("t1"."id" IN (?, ?))) ORDER BY "t1"."id" DESC LIMIT 5 OFFSET 5'''
         ))
+
+
+class PeeweeDeltaQueryBuilderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        args = {
+            'select': 'id,name,author{id,name}',
+            'since': '2017-06-01 12:00:00',
+            'since_id': '3',
+            'limit': 5
+        }
+        cls.builder = PeeweeQueryBuilder(
+            Book, args, modified_field='updated_at', tombstone_model=BookDeleted
+        )
+
+    def test_since(self):
+        self.assertTrue(self.builder.is_delta)
+        self.assertEqual(self.builder.since, datetime.datetime(2017, 6, 1, 12))
+        self.assertEqual(self.builder.since_id, 3)
+        self.assertFalse(PeeweeQueryBuilder(Book, {'since': '2017-06-01'}).is_delta)
+
+    def test_invalid_since(self):
+        with self.assertRaises(ParserException):
+            PeeweeQueryBuilder(Book, {'since': 'garbage'}, modified_field='updated_at')
+        with self.assertRaises(ParserException):
+            PeeweeQueryBuilder(Book, {'since': '2017-06-01', 'since_id': 'x'}, modified_field='updated_at')
+        with self.assertRaises(ParserException):
+            PeeweeQueryBuilder(Book, {'since': '2017-06-01', 'limit': 0}, modified_field='updated_at')
+
+    def test_since_field_filter(self):
+        # since is a plain field filter when delta mode not configured
+        sql, params = PeeweeQueryBuilder(Event, {'select': 'id', 'since': '2017-01-01'}).build().sql()
+        self.assertIn('''WHERE ("t1"."since" = ?)''', sql)
+        self.assertListEqual(params[:1], ['2017-01-01'])
+
+    def test_watermark_fields(self):
+        self.assertListEqual(self.builder.watermark_fields(), [Book.updated_at, Author.updated_at])
+
+    def test_watermark(self):
+        class GreatestQueryBuilder(PeeweeQueryBuilder):
+            greatest_function = 'GREATEST'
+
+        builder = GreatestQueryBuilder(
+            Book, {'select': 'id,author{id}', 'since': '2017-06-01'}, modified_field='updated_at'
+        )
+        sql = Book.select(builder.watermark()).sql()[0]
+        self.assertIn(
+            '''GREATEST(COALESCE("t1"."updated_at", "t2"."updated_at"), COALESCE("t2"."updated_at", "t1"."updated_at"))''',
+            sql
+        )
+
+
+# delta sync models on in-memory sqlite database
+db = SqliteDatabase(':memory:')
+
+
+class Writer(Model):
+    name = CharField()
+    updated_at = DateTimeField(null=True)
+
+    class Meta:
+        database = db
+
+
+class Novel(Model):
+    name = CharField()
+    writer = ForeignKeyField(Writer)
+    updated_at = DateTimeField()
+
+    class Meta:
+        database = db
+
+
+class Chapter(Model):
+    code = PrimaryKeyField()
+    name = CharField()
+    updated_at = DateTimeField()
+
+    class Meta:
+        database = db
+
+
+class NovelDeleted(Model):
+    object_id = IntegerField()
+    updated_at = DateTimeField()
+
+    class Meta:
+        database = db
+
+
+def day(n):
+    return datetime.datetime(2017, 6, n)
+
+
+class PeeweeDeltaSerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        db.create_tables([Writer, Novel, Chapter, NovelDeleted])
+        self.w1 = Writer.create(name='w1', updated_at=day(1))
+        self.w2 = Writer.create(name='w2', updated_at=None)
+        # bulk update, 5 novels share one timestamp
+        for i in range(5):
+            Novel.create(name='n{}'.format(i), writer=self.w1, updated_at=day(3))
+        Novel.create(name='n5', writer=self.w2, updated_at=day(4))
+
+    def tearDown(self):
+        db.drop_tables([NovelDeleted, Chapter, Novel, Writer])
+
+    def sync(self, since, since_id=None, limit=2, select='id,name,writer{id,name}', model=Novel):
+        args = {'select': select, 'since': since, 'limit': limit}
+        if since_id is not None:
+            args['since_id'] = since_id
+        builder = PeeweeQueryBuilder(
+            model, args, modified_field='updated_at', tombstone_model=NovelDeleted
+        )
+        serializer = PeeweeSerializer(object_list=builder.build(), select_args=builder.parser.select_list)
+        return serializer.delta_data(builder)
+
+    def sync_all(self, since, limit=2, select='id,name,writer{id,name}', key='id', model=Novel):
+        rows, deleted, since_id = [], [], None
+        while True:
+            data = self.sync(since, since_id, limit=limit, select=select, model=model)
+            rows.extend(obj[key] for obj in data['object_list'])
+            deleted.extend(data['deleted'])
+            since, since_id = str(data['watermark']), data['watermark_id']
+            if len(data['object_list']) < limit:
+                return rows, deleted, data['watermark']
+
+    def test_page_through_same_timestamp(self):
+        data = self.sync('2017-06-02')
+        self.assertListEqual([obj['id'] for obj in data['object_list']], [1, 2])
+        self.assertEqual(data['watermark'], day(3))
+        self.assertEqual(data['watermark_id'], 2)
+        ids, deleted, watermark = self.sync_all('2017-06-02')
+        self.assertListEqual(ids, [1, 2, 3, 4, 5, 6])
+        self.assertEqual(watermark, day(4))
+
+    def test_page_without_primary_key(self):
+        names, deleted, watermark = self.sync_all('2017-06-02', select='name', key='name')
+        self.assertListEqual(names, ['n0', 'n1', 'n2', 'n3', 'n4', 'n5'])
+        writers, deleted, watermark = self.sync_all('2017-06-02', select='writer{name}', key='writer')
+        self.assertListEqual([w['name'] for w in writers], ['w1'] * 5 + ['w2'])
+
+    def test_custom_primary_key(self):
+        for i in range(3):
+            Chapter.create(name='c{}'.format(i), updated_at=day(3))
+        names, deleted, watermark = self.sync_all('2017-06-02', select='name', key='name', model=Chapter)
+        self.assertListEqual(names, ['c0', 'c1', 'c2'])
+
+    def test_joined_model_change(self):
+        Writer.update(updated_at=day(5)).where(Writer.id == self.w1.id).execute()
+        ids, deleted, watermark = self.sync_all('2017-06-04')
+        self.assertListEqual(ids, [1, 2, 3, 4, 5])
+        self.assertEqual(watermark, day(5))
+        # joined model not in select tree
+        data = self.sync('2017-06-04', limit=10, select='id,name')
+        self.assertListEqual(data['object_list'], [])
+
+    def test_tombstones(self):
+        NovelDeleted.create(object_id=10, updated_at=day(2))
+        NovelDeleted.create(object_id=11, updated_at=day(3))
+        NovelDeleted.create(object_id=12, updated_at=day(5))
+        # full page stop at day 3
+        data = self.sync('2017-06-01')
+        self.assertEqual(data['watermark'], day(3))
+        self.assertListEqual(data['deleted'], [10, 11])
+        data = self.sync('2017-06-03', since_id=2, limit=10)
+        self.assertListEqual([obj['id'] for obj in data['object_list']], [3, 4, 5, 6])
+        self.assertListEqual(data['deleted'], [12])
+        self.assertEqual(data['watermark'], day(5))
+        self.assertIsNone(data['watermark_id'])
+
+    def test_nothing_changed(self):
+        data = self.sync('2017-06-04')
+        self.assertListEqual(data['object_list'], [])
+        self.assertListEqual(data['deleted'], [])
+        self.assertEqual(data['watermark'], day(4))
+        data = self.sync('2017-06-10')
+        self.assertEqual(data['watermark'], day(10))
+
+    def test_not_delta(self):
+        builder = PeeweeQueryBuilder(Novel, {'select': 'id'})
+        serializer = PeeweeSerializer(object_list=builder.build(), select_args=builder.parser.select_list)
+        with self.assertRaises(ValueError):
+            serializer.delta_data(builder)